@@ -9,26 +9,61 @@
 from minisom import MiniSom
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
+import polars as pl
 
 
 # Importing the dataset (the dataset is taken from: https://archive.ics.uci.edu/ml/datasets/statlog+(australian+credit+approval))
-dataset = pd.read_csv('Credit_Card_Applications.csv')
+# We use Polars instead of Pandas: it reads the CSV faster and stores the data column by column,
+# so the whole table can be turned into a NumPy array at once (instead of indexing it row by row)
+dataset = pl.read_csv('Credit_Card_Applications.csv')
 print(dataset)
+data = dataset.to_numpy() # all the columns as one (float) NumPy array
+customer_ids = dataset[:, 0].to_numpy() # the customer IDs (first column), kept as integers
 # We are going to create subsets from the dataset. The first will be the whole 
 # dataset without the last column. The last column is the "class" of the customer
 # which shows whether her application for the credit card was actually approved or not
 # We want to separate that column from our input to the SOM 
 # IMPORTANT: the SOM we are going to create will NOT predict Y because what we are doing
 # is unsupervised learning. We are only separating Y because it's irrelevant to the model
-X = dataset.iloc[:, :-1].values # get the dataset except for the last column
-Y = dataset.iloc[:, -1].values # the last column (the class)
+X = data[:, :-1] # get the dataset except for the last column
+Y = data[:, -1].astype(np.int64) # the last column (the class)
 
 # Feature Scaling
 # We will use Normalization (making all values between 0 and 1)
-from sklearn.preprocessing import MinMaxScaler
-sc = MinMaxScaler(feature_range = (0, 1))
-X = sc.fit_transform(X)
+# This is what sklearn's MinMaxScaler(feature_range = (0, 1)) does, but for such a small dataset
+# sklearn's validation overhead costs more than the computation itself. Instead we use a function compiled with Numba
+# that finds the minimum and the maximum of each column and normalizes it in place. It returns the minimum and the range
+# of every column so that we can inverse the transformation later on. The types of its arguments are given explicitly
+# (a float32 C-contiguous matrix), so it is compiled as soon as it is defined rather than on its first call
+# We work in single precision (float32) everywhere: it is more than enough for normalized features
+# and it halves the memory traffic (and doubles the number of values processed per SIMD instruction)
+from numba import njit
+
+@njit('Tuple((float32[::1], float32[::1]))(float32[:, ::1])', cache = True)
+def minmax_inplace(X):
+    n_samples, n_features = X.shape
+    x_min = np.empty(n_features, dtype = X.dtype)
+    x_range = np.empty(n_features, dtype = X.dtype)
+    for j in range(n_features):
+        mn = X[0, j]
+        mx = X[0, j]
+        for i in range(1, n_samples):
+            v = X[i, j]
+            if v < mn:
+                mn = v
+            elif v > mx:
+                mx = v
+        r = mx - mn
+        if r == 0: # a constant column: like MinMaxScaler we use a range of 1 (all the values become 0) instead of dividing by zero
+            r = np.float32(1.0)
+        for i in range(n_samples):
+            X[i, j] = (X[i, j] - mn) / r
+        x_min[j] = mn
+        x_range[j] = r
+    return x_min, x_range
+
+X = np.ascontiguousarray(X, dtype = np.float32)
+x_min, x_range = minmax_inplace(X)
 
 # Training SOM 
 # Self Organizaing Map doesn't have a ready made implementation in scikitlearn
@@ -50,9 +85,59 @@ from minisom import MiniSom
 som = MiniSom(x = 10, y = 10, input_len = 15, sigma = 1.0, learning_rate = 0.5)
 # Check the following steps in the SOM lecture notes
 som.random_weights_init(X)
+som._weights = som.get_weights().astype(np.float32) # MiniSom creates its weights in double precision, we convert them to float32 like X
 # num_iteration: the number of iterations we won't to apply steps 4 to 9 in the lecture notes
 # we chose 100 empirically (it's enough to yielding good results)
-som.train_random(data = X, num_iteration = 100)
+# som.train_random(data = X, num_iteration = 100) would do the training, but every iteration only updates
+# a tiny 10x10x15 array, so most of the time is spent in the Python interpreter rather than in the actual computation.
+# We therefore do exactly the same training steps in functions compiled with Numba
+# As for minmax_inplace, the types of the arguments are given explicitly, so these functions are compiled as soon as they are defined
+
+@njit('UniTuple(int64, 2)(float32[:, :, ::1], float32[::1])', fastmath = True, cache = True)
+def find_winner(W, x):
+    # Returns the coordinates of the winning node of x (the node whose weights are the closest to x), same as som.winner(x)
+    # The search starts from the node (0, 0) rather than from an infinite distance: with fastmath, Numba assumes there are no infinite values
+    best_distance = np.float32(0.0)
+    for k in range(W.shape[2]):
+        diff = x[k] - W[0, 0, k]
+        best_distance += diff * diff
+    best_x = 0
+    best_y = 0
+    for a in range(W.shape[0]):
+        for b in range(W.shape[1]):
+            d = np.float32(0.0) # squared euclidean distance between x and the node (a, b), enough to find the closest node
+            for k in range(W.shape[2]):
+                diff = x[k] - W[a, b, k]
+                d += diff * diff
+            if d < best_distance:
+                best_distance = d
+                best_x = a
+                best_y = b
+    return best_x, best_y
+
+@njit('void(float32[:, :, ::1], float32[:, ::1], int64[::1], float64, float64)', fastmath = True, cache = True)
+def train_som(W, X, iterations, sigma, learning_rate):
+    # W is updated in place. iterations holds the index of the customer picked at each iteration
+    num_iteration = iterations.shape[0]
+    for t in range(num_iteration):
+        x = X[iterations[t]]
+        win_x, win_y = find_winner(W, x)
+        # sigma and the learning rate decrease with the same rule as MiniSom's default decay function (asymptotic_decay)
+        decay = 1.0 + t / (num_iteration / 2)
+        eta = learning_rate / decay
+        sig = sigma / decay
+        d = 2 * sig * sig
+        for a in range(W.shape[0]):
+            for b in range(W.shape[1]):
+                # the gaussian neighborhood function centered in the winning node times the learning rate
+                h = np.float32(eta * np.exp(-((a - win_x) ** 2 + (b - win_y) ** 2) / d))
+                for k in range(W.shape[2]):
+                    W[a, b, k] += h * (x[k] - W[a, b, k])
+
+# Like train_random, we pick the customers in a random order (using the random generator of the SOM)
+iterations = np.arange(100, dtype = np.int64) % len(X)
+som._random_generator.shuffle(iterations)
+train_som(som.get_weights(), X, iterations, som._sigma, som._learning_rate)
 
 # Visualizing the results:
 # The grid will show the winning nodes, and for each we are going to show the MID (Mean Inter-neuron Distance)
@@ -62,79 +147,175 @@ som.train_random(data = X, num_iteration = 100)
 # when applying for a credit card, an outlier winning node represents a likely fradulent applicant
 # We are going to identify that using the colors on the map. The winning node will have colors so that the larger
 # the MID, the closet to white its color will be.
-from pylab import bone, pcolor, colorbar, plot, show # pylab is a matplotlib module
+from pylab import bone, pcolor, colorbar, scatter, show # pylab is a matplotlib module
+
+# som.winner(x) finds the winning node of a single customer, so calling it for every customer means 690 separate
+# trips through the Python interpreter. Instead we compute the winning nodes of all the customers at once.
+# Since ||x - w||^2 = ||x||^2 + ||w||^2 - 2 x.w, the distances between all the customers and all the nodes come down to
+# a single matrix product. For that, the weights are laid out as a (features, nodes) matrix, so that the product
+# runs on contiguous memory. ||x||^2 is the same for all the nodes, so it doesn't change which node is the closest and we leave it out
+def batch_winners(X, W):
+    weights = np.ascontiguousarray(W.reshape(-1, W.shape[2]).T) # column j holds the weights of the node j (nodes numbered row by row)
+    w_sq = (weights ** 2).sum(axis = 0)
+    distances = w_sq - 2 * (X @ weights) # (customers, nodes)
+    return np.stack(np.unravel_index(distances.argmin(axis = 1), W.shape[:2]), axis = 1) # the coordinates of the winning node of each customer
+
+winners = batch_winners(X, som.get_weights()) # winners[i] is the winning node of the customer i (same as som.winner(X[i]))
+
+# Same result as som.distance_map(), which loops over every node and each of its 8 neighbors in Python.
+# Every distance between two neighboring nodes is computed once for the whole grid with shifted slices of the weights
+# (horizontal, vertical and the two diagonal directions), and is then added to the MID of both nodes
+def distance_map(W):
+    um = np.zeros(W.shape[:2], dtype = W.dtype)
+    d = np.linalg.norm(W[1:, :] - W[:-1, :], axis = -1) # between (x, y) and (x + 1, y)
+    um[1:, :] += d
+    um[:-1, :] += d
+    d = np.linalg.norm(W[:, 1:] - W[:, :-1], axis = -1) # between (x, y) and (x, y + 1)
+    um[:, 1:] += d
+    um[:, :-1] += d
+    d = np.linalg.norm(W[1:, 1:] - W[:-1, :-1], axis = -1) # between (x, y) and (x + 1, y + 1)
+    um[1:, 1:] += d
+    um[:-1, :-1] += d
+    d = np.linalg.norm(W[1:, :-1] - W[:-1, 1:], axis = -1) # between (x, y + 1) and (x + 1, y)
+    um[1:, :-1] += d
+    um[:-1, 1:] += d
+    return um / um.max() # normalized so that the largest MID is 1
+
 bone() # creates a window that will contain the map
-pcolor(som.distance_map().T) # som.distance_map() returns a matrix of MID for all the winning nodes. We need to apply the transpose method T to fit it to the pcolor method
+pcolor(distance_map(som.get_weights()).T) # distance_map() returns a matrix of MID for all the winning nodes. We need to apply the transpose method T to fit it to the pcolor method
 colorbar()
 markers = ['o', 's'] # Create two markers o: circle, and s: square
 colors = ['r', 'g'] # Create two colors r: red, and g: green
-for i, x in enumerate(X): # i will be the indexes in X, and x will be the row of that index in the dataset (associated with the customer)
-    w = som.winner(x) # returns the winning node associated with the customer. The winning node is the square in the plotted map
-    plot(w[0] + 0.5, w[1] + 0.5, # w[0] and w[1] represent the lower left corner of the square representing the winning node in the plot. We want the maker to be displayed in the middle of the square, therefore we add 0.5
-        markers[Y[i]], # if Y[i] = 0 that means that the customer's application was not approved, so we want to display a red circle in this case, if Y[1] mean approved and we want to display a green square
-        markeredgecolor=colors[Y[i]], markerfacecolor = 'None', # we don't want to color the markers, because for some squares (winning nodes), there are some customers who got approved and other who didn't: in the same winning node square, we can find both red circles and green squares
-        markersize = 10,
-        markeredgewidth = 2)
+# Instead of plotting every customer on its own (690 separate plot calls), we draw all the customers of the same class with a single scatter call
+for c in (0, 1): # if c = 0 that means that the customer's application was not approved, so we want to display red circles in this case, c = 1 means approved and we want to display green squares
+    w = winners[Y == c] # the winning nodes associated with the customers of the class c. The winning node is the square in the plotted map
+    scatter(w[:, 0] + 0.5, w[:, 1] + 0.5, # w[:, 0] and w[:, 1] represent the lower left corner of the square representing the winning node in the plot. We want the maker to be displayed in the middle of the square, therefore we add 0.5
+        marker = markers[c],
+        edgecolors = colors[c], facecolors = 'none', # we don't want to color the markers, because for some squares (winning nodes), there are some customers who got approved and other who didn't: in the same winning node square, we can find both red circles and green squares
+        s = 100, # the area of the marker (same size as markersize = 10 with plot)
+        linewidths = 2)
     
 show()
 
 # Finding the frauds
-mappings = som.win_map(data = X) # this method returns a mapping of all winning nodes to their associated data points in the dataset. The data returned is in the form of a dictionary where the key is a tuple that represents the coordinates of the winning node, and the value is the list of customers that are associated to that winning node
+# We already know the winning node of every customer (winners), so there is no need to build the full
+# mapping of all the winning nodes to their customers with som.win_map(data = X): we only select the customers of the nodes we are interested in
 # In the course, there were two squares whose color was white.
 # The coordinates of these squares are (5, 3) and (8, 3) respectively (the coordinates of a square are the ones of the bottom left point of the square)
 # White squares reflect high MID and therefore potentially contain the cheating customers
 # Note: that for every run of this code, the squares with white color change. But we will stick 
 # to the squares (the coordinates) that were mentioned in the course.
-print(mappings)
-frauds = np.concatenate((mappings[(5, 3)], mappings[(8, 3)]), axis = 0) # concatenating the list of customers associated with the two winning nodes vertically
-# after the concatenation the list in frauds acutally contain the customers who are *potentially* frauds
-frauds = sc.inverse_transform(frauds) # Since we scaled (normalized) the data set, we need to return the data associated with the list potentially fraudulent customers to its original form, so we do an inverse transform
-# after descaling, the first column is that of the customer IDs
+fraud_nodes = np.array([(5, 3), (8, 3)])
+grid_y = som.get_weights().shape[1]
+# Packing the coordinates (x, y) of a node into the single number x * grid_y + y lets us find the customers of both nodes with one vectorized lookup
+mask = np.isin(winners[:, 0] * grid_y + winners[:, 1], fraud_nodes[:, 0] * grid_y + fraud_nodes[:, 1])
+frauds = X[mask] # the customers associated with the two winning nodes
+# frauds acutally contain the customers who are *potentially* frauds
+# Since we scaled (normalized) the data set, we need to return the data associated with the list potentially fraudulent customers to its original form, so we do an inverse transform
+# The descaled frauds are only meant to be inspected by a human (nothing below uses them)
+# frauds is already a new array (selecting with a mask copies the rows), so the inverse transform is done in place without any other allocation
+np.multiply(frauds, x_range, out = frauds)
+np.add(frauds, x_min, out = frauds)
+# after descaling, the first column is that of the customer IDs. But scaling and descaling ((x - min) / range * range + min)
+# can introduce floating point rounding errors, so we take the IDs of the fraudulent customers directly from the integer column instead
+fraud_ids = customer_ids[mask]
 # We can therefore give this list of IDs to the bank employees so that they can conduct further investigation to know which customers actualy cheated although they were granted the credit card
 
 
 # Part 2 - Going from Unsupervised to Supervised Deep Learning (Artificial Neural Network)
 # Creating a matrix of features
-customers = dataset.iloc[:, 1:].values # We include all columns except the first one (which is the customer ID and we don't need it in the matrix of features). Note: here we included the last column because it's the class (whether the application for credit card was accepted or not) because we may need this feature later on
+customers = np.ascontiguousarray(data[:, 1:], dtype = np.float32) # We include all columns except the first one (which is the customer ID and we don't need it in the matrix of features). Note: here we included the last column because it's the class (whether the application for credit card was accepted or not) because we may need this feature later on
+# The matrix is copied right away into a contiguous float32 array, so it can be scaled in place below
 # Creating the dependent variable:
-is_fraud = np.zeros(len(dataset)) # Creating a vector with the length of the dataset initialized with zeros (initially, we assume that all the customers are not fraudelent)
 # We are going to consider the customers who are in the white squares in the SOM above to be the fraudulent ones
 # Therefore we are going to set to 1 their positions in the is_fraud vector (the vector is indexed by the customer ID)
-for i in range(len(dataset)):
-    if dataset.iloc[i, 0] in frauds: # if the customer ID in question is in the frauds, we set the value for that customer ID in the in_fraud vector to 1 (the vector is indexed by the customer ID)
-        is_fraud[i] = 1
+is_fraud = mask.astype(np.float32) # mask already tells which customers are in the white squares, so there is no need to look up their IDs
 
 # Building the ANN:
 # Feature Scaling
-from sklearn.preprocessing import StandardScaler
-sc = StandardScaler()
-customers = sc.fit_transform(customers) # No need to scale the dependent variable because it takes the values 0 and 1
+# Standardization (what sklearn's StandardScaler does) done directly with NumPy, in place and without intermediate copies
+# We keep the mean (mu) and the standard deviation (sigma) of every column in case we need to inverse the transformation
+mu = customers.mean(axis = 0)
+sigma = customers.std(axis = 0)
+sigma[sigma == 0] = 1 # a constant column: like StandardScaler we use a standard deviation of 1 instead of dividing by zero
+np.subtract(customers, mu, out = customers)
+np.divide(customers, sigma, out = customers) # No need to scale the dependent variable because it takes the values 0 and 1
 
-# Importing the Keras libraries and packages
-from keras.models import Sequential
-from keras.layers import Dense
+# The ANN is tiny (15 inputs, 2 hidden neurons, 1 output), so instead of Keras (and TensorFlow behind it), whose import
+# and graph construction take far more time than the training itself, we write the forward and backward passes with NumPy
+rng = np.random.default_rng()
 
 # Initializing the ANN
-classifier = Sequential()
-
 # Adding the input layer and the first hidden layer
 # Since we have only 690 data points, it's a very simple dataset. Therefore, we only use 2 neurons and only one hidden layer
-# Since we have 15 features, we set the input dimensions (input_dim) to 15
-classifier.add(Dense(units = 2, kernel_initializer = 'uniform', activation = 'relu', input_dim = 15 ))
+# Since we have 15 features, the input dimension is 15
+# The weights are drawn uniformly between -0.05 and 0.05 (what kernel_initializer = 'uniform' does in Keras) and the biases start at 0
+W1 = rng.uniform(-0.05, 0.05, (15, 2)).astype(np.float32)
+b1 = np.zeros(2, dtype = np.float32)
 
 # Adding the output layer
-classifier.add(Dense(units = 1, kernel_initializer = 'uniform', activation = 'sigmoid'))
+W2 = rng.uniform(-0.05, 0.05, (2, 1)).astype(np.float32)
+b2 = np.zeros(1, dtype = np.float32)
+params = [W1, b1, W2, b2]
+
+def forward(inputs):
+    hidden = np.maximum(0, inputs @ W1 + b1) # relu activation
+    output = 1 / (1 + np.exp(-(hidden @ W2 + b2))) # sigmoid activation: the probability of fraud
+    return hidden, output
 
 # Compiling the ANN
-classifier.compile(optimizer = 'adam', loss = 'binary_crossentropy', metrics = ['accuracy'])
+# We use the adam optimizer (with the default hyperparameters of Keras) and the binary_crossentropy loss
+learning_rate, beta_1, beta_2, epsilon = 0.001, 0.9, 0.999, 1e-7
+first_moments = [np.zeros_like(param) for param in params]
+second_moments = [np.zeros_like(param) for param in params]
+step = 0
 
 # Fitting the ANN to the training set
-# Again, because of the simplicity of the dataset, we set the batch_size to 1 and the number of epochs to 2
-classifier.fit(customers, is_fraud, batch_size = 1, epochs = 2)
+# Training on one customer at a time (batch_size = 1) runs a separate tiny forward/backward pass for every customer.
+# With batch_size = 32 each step is a single matrix product over 32 customers, which is much faster.
+# Since there are 32 times fewer weight updates per epoch, we train for more epochs (20 instead of 2)
+batch_size = 32
+epochs = 20
+targets = is_fraud.reshape(-1, 1)
+for epoch in range(epochs):
+    order = rng.permutation(len(customers)) # the customers are shuffled at every epoch
+    for start in range(0, len(customers), batch_size):
+        batch = order[start:start + batch_size]
+        inputs, y = customers[batch], targets[batch]
+        hidden, output = forward(inputs)
+        # Backpropagation: with a sigmoid output and the binary cross-entropy loss,
+        # the gradient of the (batch averaged) loss with respect to the output layer's input is simply (output - y)
+        grad_output = (output - y) / len(batch)
+        grad_hidden = (grad_output @ W2.T) * (hidden > 0)
+        grads = [np.einsum('bi,bj->ij', inputs, grad_hidden), grad_hidden.sum(axis = 0),
+                 np.einsum('bi,bj->ij', hidden, grad_output), grad_output.sum(axis = 0)]
+        # Adam update (the parameters are updated in place)
+        step += 1
+        for param, grad, m, v in zip(params, grads, first_moments, second_moments):
+            m *= beta_1
+            m += (1 - beta_1) * grad
+            v *= beta_2
+            v += (1 - beta_2) * grad ** 2
+            param -= learning_rate * (m / (1 - beta_1 ** step)) / (np.sqrt(v / (1 - beta_2 ** step)) + epsilon)
+    _, output = forward(customers)
+    probabilities = np.clip(output, epsilon, 1 - epsilon)
+    loss = -np.mean(targets * np.log(probabilities) + (1 - targets) * np.log(1 - probabilities))
+    accuracy = np.mean((output > 0.5) == targets)
+    print(f'Epoch {epoch + 1}/{epochs} - loss: {loss:.4f} - accuracy: {accuracy:.4f}')
 
 # Predicting the probabilities of frauds (among all customers)
-y_pred = classifier.predict(customers)
-y_pred = np.concatenate((dataset.iloc[:, 0:1].values, y_pred), axis = 1) # Horizontal concatenation to have a two-dimensional array that contains the customer IDs and the fraud probabilities
-y_pred = y_pred[y_pred[:, 1].argsort()] # Sorting the y_pred array by the second column (fraud probability) in ascending order
+_, y_pred = forward(customers)
+y_pred = np.concatenate((customer_ids.reshape(-1, 1), y_pred), axis = 1) # Horizontal concatenation to have a two-dimensional array that contains the customer IDs and the fraud probabilities
+# Only the customers with the highest fraud probabilities are worth investigating, so instead of sorting all the customers
+# we find the K-th highest probability with np.partition (linear time) and only sort the customers at or above it.
+# Many customers can share exactly the same probability, so we keep all the customers tied with the K-th one
+# (rather than an arbitrary subset of them), which means that there can be more than K customers
+K = 50
+threshold = np.partition(y_pred[:, 1], -K)[-K]
+top = np.flatnonzero(y_pred[:, 1] >= threshold)
+top = top[np.argsort(-y_pred[top, 1], kind = 'stable')] # Sorting them by the second column (fraud probability) in descending order
+y_pred = y_pred[top]
 
-print(y_pred)
\ No newline at end of file
+print(y_pred)
+print(f'{len(top)} customers with a fraud probability of at least {threshold:.4f} '
+      f'({np.count_nonzero(y_pred[:, 1] == threshold)} of them tied at exactly that probability)')
\ No newline at end of file